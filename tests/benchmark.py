@@ -0,0 +1,375 @@
+'''
+Benchmarks de pyweather contra un servidor local que imita a OpenWeatherMap (ver stub_server.py).
+No necesita clave API ni acceso a la red.
+
+Para cada escenario se mide el throughput (operaciones con éxito por segundo), la latencia (p50 y p99)
+de las operaciones con éxito, la tasa de errores y el pico de memoria. Cada escenario se repite
+varias veces y se guarda la mediana y la dispersión entre repeticiones. Los resultados se guardan
+en un fichero JSON y se comparan con la ejecución anterior para detectar regresiones.
+
+e.g:
+PYTHONPATH=. python tests/benchmark.py --latency 20 --error-rate 0.01
+PYTHONPATH=. python tests/benchmark.py --scenarios single_city bulk_fanout --fail-on-regression
+'''
+
+from provider import *
+from cities import *
+from stub_server import StubServer
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from os.path import join, dirname, exists
+from random import Random
+from time import perf_counter
+from math import ceil
+from statistics import median
+import argparse
+import json
+import sys
+import tracemalloc
+
+
+class BenchmarkResult:
+    '''
+    Almacena las mediciones de un escenario. Cada escenario se ejecuta varias veces (pasadas);
+    el throughput y la latencia que se guardan son la mediana de las pasadas, junto con su
+    dispersión (ver to_dict).
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.passes = []
+        self.errors = {}
+        self.peak_memory = 0
+
+
+    @staticmethod
+    def _percentile(values, p):
+        if len(values) == 0:
+            return None
+        # Método nearest-rank
+        values = sorted(values)
+        k = max(ceil(p / 100.0 * len(values)) - 1, 0)
+        return values[min(k, len(values) - 1)]
+
+    @staticmethod
+    def _is_rate_limited(error):
+        return error == 'Server response with 429'
+
+
+    def add_pass(self, measures, elapsed, server_requests):
+        '''
+        Añade los resultados de una pasada.
+        :param measures: Es una lista de tuplas (latencia, error). error es None si la operación
+        ha tenido éxito.
+        :param elapsed: Segundos que ha durado la pasada
+        :param server_requests: Número de peticiones que ha recibido el servidor durante la pasada
+        '''
+        latencies = [latency for latency, error in measures if error is None]
+        errors = [error for latency, error in measures if not error is None]
+        for error in errors:
+            self.errors[error] = self.errors.get(error, 0) + 1
+
+        # El throughput y los percentiles se calculan solo con las operaciones que han tenido éxito
+        # (una respuesta 429 rápida no debe parecer una mejora del rendimiento).
+        self.passes.append({
+            'ops' : len(measures),
+            'failures' : len(errors),
+            'rate_limited' : len([error for error in errors if self._is_rate_limited(error)]),
+            'server_requests' : server_requests,
+            'elapsed_s' : elapsed,
+            'throughput_ops_s' : len(latencies) / elapsed if elapsed > 0 else None,
+            'p50_ms' : self._percentile(latencies, 50) * 1000 if len(latencies) > 0 else None,
+            'p99_ms' : self._percentile(latencies, 99) * 1000 if len(latencies) > 0 else None
+        })
+
+
+    def to_dict(self):
+        '''
+        :return: Devuelve un diccionario con la mediana de cada métrica entre todas las pasadas.
+        "spread" contiene, para cada métrica, la diferencia entre la mejor y la peor pasada
+        relativa a la mediana (es el ruido entre pasadas).
+        Las tasas de error se calculan sobre el total de operaciones de todas las pasadas.
+        "server_error_rate" no incluye las respuestas 429.
+        '''
+        ops = sum(measure['ops'] for measure in self.passes)
+        failures = sum(measure['failures'] for measure in self.passes)
+        rate_limited = sum(measure['rate_limited'] for measure in self.passes)
+        data = {
+            'repeats' : len(self.passes),
+            'ops' : ops,
+            'successes' : ops - failures,
+            'error_rate' : round(failures / ops, 4) if ops > 0 else None,
+            'server_error_rate' : round((failures - rate_limited) / ops, 4) if ops > 0 else None,
+            'errors' : self.errors,
+            'server_requests' : int(median(measure['server_requests'] for measure in self.passes)),
+            'peak_memory_kb' : round(self.peak_memory / 1024, 1),
+            'spread' : {}
+        }
+        for key, digits in (('elapsed_s', 4), ('throughput_ops_s', 2), ('p50_ms', 3), ('p99_ms', 3)):
+            values = [measure[key] for measure in self.passes if not measure[key] is None]
+            if len(values) == 0:
+                data[key] = None
+                continue
+            data[key] = round(median(values), digits)
+            data['spread'][key] = round((max(values) - min(values)) / data[key], 4) if data[key] > 0 else 0
+        return data
+
+
+
+def _run(operation):
+    start = perf_counter()
+    try:
+        operation()
+        error = None
+    except Exception as e:
+        error = str(e)
+    return perf_counter() - start, error
+
+def _run_all(operations, workers):
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            return list(executor.map(_run, operations))
+    return [_run(operation) for operation in operations]
+
+
+def measure(name, operations, stub, args, workers = 1, setup = None):
+    '''
+    Ejecuta y mide una lista de operaciones.
+    Primero se ejecutan --warmup pasadas que no se miden. Después --repeats pasadas en las que se
+    miden los tiempos y, por último, una pasada con tracemalloc activo para medir el pico de
+    memoria (tracemalloc ralentiza mucho la ejecución).
+    Antes de cada pasada se reinicia el estado del servidor, de forma que los errores que se
+    obtienen no dependen de los escenarios o pasadas anteriores.
+    :param operations: Es una lista de funciones sin parámetros. Cada una es una operación.
+    :param workers: Número de hilos que ejecutan las operaciones de forma concurrente.
+    :param setup: Si no es None, es una función que se ejecuta antes de cada pasada (e.g para
+    dejar la caché del proxy en el mismo estado)
+    :return: Devuelve una instancia de BenchmarkResult
+    '''
+    result = BenchmarkResult(name)
+
+    def prepare():
+        if not setup is None:
+            setup()
+        stub.reset(args.seed)
+
+    for k in range(args.warmup):
+        prepare()
+        _run_all(operations, workers)
+
+    for k in range(args.repeats):
+        prepare()
+        start = perf_counter()
+        measures = _run_all(operations, workers)
+        elapsed = perf_counter() - start
+        result.add_pass(measures, elapsed, stub.get_request_count())
+
+    prepare()
+    tracemalloc.start()
+    _run_all(operations, workers)
+    result.peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result
+
+
+
+def _city(id):
+    return City(id, 'City {}'.format(id), 'es', (0.0, 0.0))
+
+def _clear_cache():
+    OpenWeatherMapProxy().cache.clear()
+
+
+
+def scenario_single_city(provider, stub, args):
+    '''
+    Latencia de una consulta del tiempo actual de una ciudad (sin caché)
+    '''
+    city = _city(3117735)
+    def operation():
+        _clear_cache()
+        provider.get_current_weather(city = city)
+    return measure('single_city', [operation] * args.requests, stub, args)
+
+
+def scenario_bulk_fanout(provider, stub, args):
+    '''
+    Consulta concurrente del tiempo actual de muchas ciudades distintas
+    '''
+    operations = [(lambda city: lambda: provider.get_current_weather(city = city))(_city(id))
+                  for id in range(1, args.requests + 1)]
+    return measure('bulk_fanout', operations, stub, args, workers = args.workers, setup = _clear_cache)
+
+
+def scenario_cache_mix(provider, stub, args):
+    '''
+    Mezcla de consultas que están en la caché del proxy y consultas que no lo están.
+    La proporción de aciertos se indica con --hit-ratio
+    '''
+    _clear_cache()
+    stub.reset(args.seed)
+    rng = Random(args.seed)
+    warm_cities = []
+    for city in [_city(id) for id in range(1, 51)]:
+        # Solo las consultas que hayan tenido éxito quedan en la caché
+        try:
+            provider.get_current_weather(city = city)
+            warm_cities.append(city)
+        except Exception:
+            pass
+
+    if len(warm_cities) == 0:
+        print('Skipping cache_mix: every warm-up request failed')
+        return None
+    warm_cache = dict(OpenWeatherMapProxy().cache)
+    def setup():
+        _clear_cache()
+        OpenWeatherMapProxy().cache.update(warm_cache)
+
+    operations = []
+    for k in range(args.requests):
+        city = rng.choice(warm_cities) if rng.random() < args.hit_ratio else _city(100000 + k)
+        operations.append((lambda city: lambda: provider.get_current_weather(city = city))(city))
+    return measure('cache_mix', operations, stub, args, setup = setup)
+
+
+def scenario_history_backfill(provider, stub, args):
+    '''
+    Consulta del historial de un año completo (una medición por día) de varias ciudades
+    '''
+    start, end = datetime(year = 2016, month = 1, day = 1), datetime(year = 2016, month = 12, day = 31)
+    operations = [(lambda city: lambda: provider.get_weather_history(start = start, end = end, city = city, interval = 1))(_city(id))
+                  for id in range(1, max(args.requests // 10, 1) + 1)]
+    return measure('history_backfill', operations, stub, args, setup = _clear_cache)
+
+
+def scenario_city_resolution(provider, stub, args):
+    '''
+    Búsqueda de ciudades por nombre y por ID en data/cities.db
+    '''
+    if not exists(City.cities_db_path):
+        print('Skipping city_resolution: {} not found'.format(City.cities_db_path))
+        return None
+
+    names = ['Madrid', 'Barcelona', 'Olite', 'Pamplona', 'Sevilla', 'Valencia', 'Bilbao', 'Zaragoza']
+    def by_name(name):
+        return lambda: City.get_by_name(name = name, country = 'es')
+    def by_id():
+        return City.get_by_id(id = 3117735)
+
+    operations = []
+    for k in range(args.requests):
+        operations.append(by_name(names[k % len(names)]) if k % 2 == 0 else by_id)
+    return measure('city_resolution', operations, stub, args)
+
+
+scenarios = {
+    'single_city' : scenario_single_city,
+    'bulk_fanout' : scenario_bulk_fanout,
+    'cache_mix' : scenario_cache_mix,
+    'history_backfill' : scenario_history_backfill,
+    'city_resolution' : scenario_city_resolution
+}
+
+
+
+def compare(previous, current, threshold, error_floor = 0.02):
+    '''
+    Compara los resultados de esta ejecución con los de la anterior.
+    Un cambio en el throughput o en la latencia p99 solo se considera una regresión si supera
+    tanto el umbral como el ruido entre repeticiones ("spread") de cualquiera de las dos ejecuciones.
+    :param threshold: Variación relativa (e.g 0.2 = 20%) a partir de la cual se considera que
+    hay una regresión en el throughput, en la latencia p99 o en la tasa de errores
+    :param error_floor: Aumento absoluto mínimo de la tasa de errores (sin contar las respuestas
+    429, que dependen de la temporización) para considerarlo una regresión
+    :return: Devuelve una lista con los nombres de los escenarios en los que hay regresiones
+    '''
+    regressions = []
+    for name, result in current.items():
+        if not name in previous:
+            continue
+        before = previous[name]
+        lines = []
+        regression = False
+        # Más errores es una regresión aunque el resto de métricas mejoren.
+        if not result.get('server_error_rate') is None and not before.get('server_error_rate') is None:
+            if result['server_error_rate'] > before['server_error_rate'] * (1 + threshold) and \
+                    result['server_error_rate'] - before['server_error_rate'] > error_floor:
+                regression = True
+            lines.append('server_error_rate: {} -> {}'.format(before['server_error_rate'], result['server_error_rate']))
+
+        for key, higher_is_better in (('throughput_ops_s', True), ('p50_ms', False), ('p99_ms', False), ('peak_memory_kb', False)):
+            if not before.get(key) or result.get(key) is None:
+                continue
+            change = (result[key] - before[key]) / before[key]
+            worse = -change if higher_is_better else change
+            noise = max(before.get('spread', {}).get(key, 0), result.get('spread', {}).get(key, 0))
+            if worse > max(threshold, noise) and key in ('throughput_ops_s', 'p99_ms'):
+                regression = True
+            lines.append('{}: {} -> {} ({:+.1f}%, noise {:.1f}%)'.format(key, before[key], result[key], change * 100, noise * 100))
+        print('{}{}: {}'.format(name, ' [REGRESSION]' if regression else '', ', '.join(lines)))
+        if regression:
+            regressions.append(name)
+    return regressions
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'pyweather benchmarks against a local OpenWeatherMap stub')
+    parser.add_argument('--scenarios', nargs = '+', choices = list(scenarios.keys()), default = list(scenarios.keys()))
+    parser.add_argument('--requests', type = int, default = 200, help = 'Operations per scenario')
+    parser.add_argument('--repeats', type = int, default = 5, help = 'Timed passes per scenario (the median is stored)')
+    parser.add_argument('--warmup', type = int, default = 1, help = 'Untimed passes per scenario')
+    parser.add_argument('--workers', type = int, default = 16, help = 'Threads used by bulk_fanout')
+    parser.add_argument('--hit-ratio', type = float, default = 0.8, help = 'Cache hit ratio used by cache_mix')
+    parser.add_argument('--latency', type = float, default = 0, help = 'Stub server latency (ms)')
+    parser.add_argument('--error-rate', type = float, default = 0, help = 'Probability of a 500 response')
+    parser.add_argument('--rate-limit', type = int, default = None,
+                        help = 'Requests per rate limit window before answering with 429')
+    parser.add_argument('--rate-limit-window', type = float, default = 1,
+                        help = 'Rate limit window (seconds). Use 60 to model a per-minute limit')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--results', default = join(dirname(__file__), 'benchmark_results.json'),
+                        help = 'JSON file where results of every run are stored')
+    parser.add_argument('--threshold', type = float, default = 0.2, help = 'Relative change considered a regression')
+    parser.add_argument('--error-floor', type = float, default = 0.02,
+                        help = 'Minimum absolute rise of the error rate (excluding 429) considered a regression')
+    parser.add_argument('--no-save', action = 'store_true', help = 'Do not store the results of this run')
+    parser.add_argument('--fail-on-regression', action = 'store_true')
+    args = parser.parse_args()
+
+    config = {key : value for key, value in vars(args).items() if not key in ('results', 'no_save', 'fail_on_regression', 'threshold', 'error_floor')}
+    current = {}
+
+    default_prefix_url = OpenWeatherMapProxy._OpenWeatherMapProxy.openweathermap_prefix_url
+    with StubServer(latency = args.latency / 1000.0, error_rate = args.error_rate,
+                    rate_limit = args.rate_limit, rate_limit_window = args.rate_limit_window, seed = args.seed) as stub:
+        OpenWeatherMapProxy._OpenWeatherMapProxy.openweathermap_prefix_url = stub.url
+        try:
+            provider = Provider('benchmark')
+            for name in args.scenarios:
+                result = scenarios[name](provider, stub, args)
+                if result is None:
+                    continue
+                current[name] = result.to_dict()
+                print('{}: {}'.format(name, json.dumps(current[name])))
+        finally:
+            OpenWeatherMapProxy._OpenWeatherMapProxy.openweathermap_prefix_url = default_prefix_url
+
+    # Comparamos con la última ejecución que usó la misma configuración (incluidos los escenarios).
+    runs = []
+    if exists(args.results):
+        with open(args.results) as fh:
+            runs = json.load(fh)
+    previous = [run for run in runs if run['config'] == config]
+    regressions = []
+    if len(previous) > 0:
+        print('\nComparing with run from {}'.format(previous[-1]['timestamp']))
+        regressions = compare(previous[-1]['results'], current, args.threshold, args.error_floor)
+
+    if not args.no_save:
+        runs.append({'timestamp' : datetime.utcnow().isoformat(), 'config' : config, 'results' : current})
+        with open(args.results, 'w') as fh:
+            json.dump(runs, fh, indent = 2)
+
+    if args.fail_on_regression and len(regressions) > 0:
+        sys.exit(1)
@@ -0,0 +1,304 @@
+'''
+Servidor HTTP local que imita la API de OpenWeatherMap (endpoints "weather" y "history/city").
+Se usa en los benchmarks para no depender de una clave API ni de acceso a la red.
+El servidor se ejecuta en un proceso aparte, para que su consumo de memoria y de CPU no se mezcle
+con las mediciones de la librería.
+Permite configurar la latencia de cada respuesta, la tasa de errores y el límite de peticiones
+por ventana de tiempo (a partir del cual el servidor responde con 429, como hace OpenWeatherMap).
+'''
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from multiprocessing import Process, Pipe, Value
+from threading import Lock
+from random import Random
+from time import sleep, monotonic
+from math import ceil
+import json
+
+
+class WeatherPayloads:
+    '''
+    Genera respuestas con el mismo formato que devuelve OpenWeatherMap.
+    Los valores dependen de la ID de la ciudad y del timestamp, de forma que dos
+    peticiones iguales devuelven siempre el mismo resultado.
+    '''
+    conditions = [
+        (800, 'Clear', 'clear sky'),
+        (801, 'Clouds', 'few clouds'),
+        (803, 'Clouds', 'broken clouds'),
+        (500, 'Rain', 'light rain'),
+        (600, 'Snow', 'light snow')
+    ]
+
+    @staticmethod
+    def weather(id, dt):
+        '''
+        :param id: Es la ID de la ciudad
+        :param dt: Es el timestamp (UTC) de la medición
+        :return: Devuelve un diccionario como el que devuelve el endpoint "weather"
+        '''
+        rng = Random(id * 1000003 + dt)
+        code, main, description = rng.choice(WeatherPayloads.conditions)
+        temp = round(rng.uniform(260, 310), 2)
+        data = {
+            'coord' : {'lon' : round(rng.uniform(-180, 180), 2), 'lat' : round(rng.uniform(-90, 90), 2)},
+            'weather' : [{'id' : code, 'main' : main, 'description' : description, 'icon' : '01d'}],
+            'base' : 'stations',
+            'main' : {
+                'temp' : temp,
+                'pressure' : rng.randint(990, 1030),
+                'humidity' : rng.randint(20, 100),
+                'temp_min' : round(temp - rng.uniform(0, 5), 2),
+                'temp_max' : round(temp + rng.uniform(0, 5), 2)
+            },
+            'visibility' : 10000,
+            'wind' : {'speed' : round(rng.uniform(0, 15), 2), 'deg' : rng.randint(0, 359)},
+            'clouds' : {'all' : rng.randint(0, 100)},
+            'dt' : dt,
+            'sys' : {'type' : 1, 'id' : 5488, 'message' : 0.0042, 'country' : 'ES',
+                     'sunrise' : dt - 21600, 'sunset' : dt + 21600},
+            'id' : id,
+            'name' : 'City {}'.format(id),
+            'cod' : 200
+        }
+        if main == 'Rain':
+            data['rain'] = {'3h' : round(rng.uniform(0, 10), 2)}
+        elif main == 'Snow':
+            data['snow'] = {'3h' : round(rng.uniform(0, 10), 2)}
+        return data
+
+
+    @staticmethod
+    def history(id, start, end, cnt):
+        '''
+        :return: Devuelve un diccionario como el que devuelve el endpoint "history/city", con
+        "cnt" mediciones repartidas uniformemente entre "start" y "end"
+        '''
+        cnt = max(cnt, 1)
+        step = max((end - start) // cnt, 1)
+        measures = []
+        for k in range(cnt):
+            data = WeatherPayloads.weather(id, start + k * step)
+            for key in ('coord', 'base', 'visibility', 'sys', 'id', 'name', 'cod'):
+                del data[key]
+            measures.append(data)
+        return {'message' : '', 'cod' : '200', 'city_id' : id, 'calctime' : 0.0123,
+                'cnt' : len(measures), 'list' : measures}
+
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    # La cola por defecto (5 conexiones) provoca reintentos de conexión de 1s cuando se
+    # lanzan muchas peticiones concurrentes.
+    request_queue_size = 128
+    daemon_threads = True
+
+
+
+class _StubState:
+    '''
+    Estado del servidor dentro del proceso hijo: decide con que código de estado se
+    responde cada petición.
+    El proceso padre puede reiniciar este estado (ver StubServer.reset) cambiando el valor
+    compartido "generation".
+    '''
+    def __init__(self, latency, error_rate, rate_limit, rate_limit_window, request_count, seed, generation):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.request_count = request_count
+        self.shared_seed = seed
+        self.shared_generation = generation
+        self.generation = None
+        self.lock = Lock()
+
+
+    def next_status(self):
+        '''
+        :return: Devuelve el código de estado de la respuesta y, si es 429, los segundos que
+        quedan hasta que se reinicie la ventana del límite de peticiones.
+        '''
+        with self.request_count.get_lock():
+            self.request_count.value += 1
+
+        with self.lock:
+            now = monotonic()
+            # Si el proceso padre ha pedido un reinicio, volvemos a sembrar el generador de
+            # errores y empezamos una nueva ventana.
+            if self.generation != self.shared_generation.value:
+                self.generation = self.shared_generation.value
+                self.random = Random(self.shared_seed.value)
+                self.window_start, self.window_requests = now, 0
+
+            if not self.rate_limit is None:
+                if now - self.window_start >= self.rate_limit_window:
+                    self.window_start, self.window_requests = now, 0
+                self.window_requests += 1
+                if self.window_requests > self.rate_limit:
+                    return 429, max(ceil(self.window_start + self.rate_limit_window - now), 1)
+
+            if self.error_rate > 0 and self.random.random() < self.error_rate:
+                return 500, None
+        return 200, None
+
+
+
+def _serve(state_args, conn):
+    '''
+    Punto de entrada del proceso hijo: arranca el servidor y envía el puerto al proceso padre.
+    :param state_args: Son los parámetros del constructor de _StubState
+    '''
+    server = _HTTPServer(('127.0.0.1', 0), _Handler)
+    server.state = _StubState(*state_args)
+    conn.send(server.server_address[1])
+    conn.close()
+    server.serve_forever()
+
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        state = self.server.state
+        url = urlparse(self.path)
+        params = {key : values[0] for key, values in parse_qs(url.query).items()}
+        endpoint = url.path.split('/data/2.5/', 1)[-1]
+
+        if state.latency > 0:
+            sleep(state.latency)
+
+        if not endpoint in ('weather', 'history/city'):
+            return self._reply(404, {'cod' : '404', 'message' : 'Internal error'})
+
+        status, retry_after = state.next_status()
+        if status == 429:
+            return self._reply(429, {'cod' : 429, 'message' : 'Your account is temporary blocked due to exceeding of requests limitation of your subscription type.'},
+                               headers = {'Retry-After' : str(retry_after)})
+        if status != 200:
+            return self._reply(status, {'cod' : status, 'message' : 'Internal server error'})
+
+        try:
+            id = int(params.get('id', 0))
+            if endpoint == 'weather':
+                body = WeatherPayloads.weather(id, 1500000000 + id % 600)
+            else:
+                body = WeatherPayloads.history(id, int(params['start']), int(params['end']), int(params['cnt']))
+        except (KeyError, ValueError):
+            return self._reply(400, {'cod' : '400', 'message' : 'Invalid request parameters'})
+        self._reply(200, body)
+
+
+    def _reply(self, status, body, headers = None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+
+class StubServer:
+    '''
+    Servidor local que responde a las peticiones como lo haría OpenWeatherMap.
+    Se ejecuta en un proceso aparte. Puede usarse como context manager:
+
+    with StubServer(latency = 0.01) as server:
+        OpenWeatherMapProxy._OpenWeatherMapProxy.openweathermap_prefix_url = server.url
+        ...
+    '''
+    # Segundos que se espera a que el proceso del servidor arranque o termine
+    timeout = 10
+
+    def __init__(self, latency = 0, error_rate = 0, rate_limit = None, rate_limit_window = 1, seed = 0):
+        '''
+        Constructor: Inicializa esta instancia.
+        :param latency: Segundos que tarda el servidor en responder a cada petición.
+        :param error_rate: Probabilidad (entre 0 y 1) de que el servidor responda con 500.
+        :param rate_limit: Número máximo de peticiones por ventana. Las peticiones que excedan
+        este límite se responderán con 429. Si es None, no hay límite.
+        :param rate_limit_window: Duración en segundos de la ventana del límite de peticiones
+        (e.g 60 para modelar el límite de 60 peticiones por minuto de la cuenta "free")
+        :param seed: Semilla para generar los errores de forma reproducible.
+        '''
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.seed = seed
+        self.request_count = Value('i', 0)
+        self.shared_seed = Value('q', seed)
+        self.generation = Value('i', 0)
+        self.process = None
+        self.port = None
+
+
+    def start(self):
+        state_args = (self.latency, self.error_rate, self.rate_limit, self.rate_limit_window,
+                      self.request_count, self.shared_seed, self.generation)
+        parent_conn, child_conn = Pipe()
+        self.process = Process(target = _serve, args = (state_args, child_conn), daemon = True)
+        self.process.start()
+        try:
+            if not parent_conn.poll(self.timeout):
+                raise RuntimeError('Stub server did not start in {}s'.format(self.timeout))
+            self.port = parent_conn.recv()
+        except:
+            self.stop()
+            raise
+        finally:
+            parent_conn.close()
+        return self
+
+    def stop(self):
+        if self.process is None:
+            return
+        self.process.terminate()
+        self.process.join(self.timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+    @property
+    def url(self):
+        '''
+        :return: Devuelve la URL que debe usarse como prefijo de la API (equivale a
+        http://api.openweathermap.org/data/2.5)
+        '''
+        return 'http://127.0.0.1:{}/data/2.5'.format(self.port)
+
+    def reset(self, seed = None):
+        '''
+        Reinicia el estado del servidor: vuelve a sembrar el generador de errores, empieza una
+        nueva ventana del límite de peticiones y pone a cero el contador de peticiones.
+        Así los errores de una serie de peticiones no dependen de las peticiones anteriores.
+        :param seed: Semilla a usar. Si es None, se usa la que se indicó en el constructor.
+        '''
+        self.shared_seed.value = self.seed if seed is None else seed
+        with self.generation.get_lock():
+            self.generation.value += 1
+        self.reset_counters()
+
+    def reset_counters(self):
+        with self.request_count.get_lock():
+            self.request_count.value = 0
+
+    def get_request_count(self):
+        '''
+        :return: Devuelve el número total de peticiones recibidas desde la última llamada a reset_counters
+        '''
+        return self.request_count.value
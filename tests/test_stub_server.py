@@ -0,0 +1,159 @@
+'''
+Tests del servidor que imita a OpenWeatherMap (stub_server.py) y de las utilidades de benchmark.py.
+No necesitan clave API ni acceso a la red.
+
+e.g:
+PYTHONPATH=. python -m unittest discover -s tests -p 'test_*.py'
+'''
+
+from provider import *
+from cities import *
+from weather import Weather
+from stub_server import StubServer, WeatherPayloads
+from benchmark import BenchmarkResult, compare
+from datetime import datetime
+from math import floor
+from time import perf_counter
+import requests
+import unittest
+
+
+class StubServerTest(unittest.TestCase):
+    def setUp(self):
+        self.default_prefix_url = OpenWeatherMapProxy._OpenWeatherMapProxy.openweathermap_prefix_url
+        OpenWeatherMapProxy().cache.clear()
+
+    def tearDown(self):
+        OpenWeatherMapProxy._OpenWeatherMapProxy.openweathermap_prefix_url = self.default_prefix_url
+        OpenWeatherMapProxy().cache.clear()
+
+
+    def test_rate_limit(self):
+        with StubServer(rate_limit = 1) as stub:
+            first = requests.get('{}/weather?id=1'.format(stub.url))
+            second = requests.get('{}/weather?id=1'.format(stub.url))
+            self.assertEqual(first.status_code, 200)
+            self.assertEqual(second.status_code, 429)
+            self.assertEqual(second.headers['Retry-After'], '1')
+            self.assertEqual(stub.get_request_count(), 2)
+
+    def test_rate_limit_window(self):
+        with StubServer(rate_limit = 1, rate_limit_window = 60) as stub:
+            requests.get('{}/weather?id=1'.format(stub.url))
+            response = requests.get('{}/weather?id=1'.format(stub.url))
+            self.assertEqual(response.status_code, 429)
+            self.assertGreater(int(response.headers['Retry-After']), 1)
+
+            # Al reiniciar el servidor empieza una nueva ventana
+            stub.reset()
+            self.assertEqual(requests.get('{}/weather?id=1'.format(stub.url)).status_code, 200)
+            self.assertEqual(stub.get_request_count(), 1)
+
+    def test_reset(self):
+        with StubServer(error_rate = 0.5, seed = 1) as stub:
+            def statuses():
+                return [requests.get('{}/weather?id=1'.format(stub.url)).status_code for k in range(20)]
+            stub.reset()
+            first = statuses()
+            stub.reset()
+            self.assertEqual(statuses(), first)
+            self.assertIn(200, first)
+            self.assertIn(500, first)
+
+    def test_stop_without_start(self):
+        stub = StubServer()
+        stub.stop()
+        stub.start()
+        stub.stop()
+        stub.stop()
+
+    def test_error_rate(self):
+        with StubServer(error_rate = 1) as stub:
+            response = requests.get('{}/weather?id=1'.format(stub.url))
+            self.assertEqual(response.status_code, 500)
+
+    def test_latency(self):
+        with StubServer(latency = 0.2) as stub:
+            start = perf_counter()
+            requests.get('{}/weather?id=1'.format(stub.url))
+            self.assertGreaterEqual(perf_counter() - start, 0.2)
+
+
+    def test_payloads(self):
+        for id in range(1, 50):
+            Weather(WeatherPayloads.weather(id, 1500000000))
+        history = WeatherPayloads.history(1, 1500000000, 1500000000 + 10 * 24 * 60 * 60, 10)
+        self.assertEqual(len(history['list']), 10)
+        for data in history['list']:
+            Weather(data)
+
+    def test_provider(self):
+        with StubServer() as stub:
+            OpenWeatherMapProxy._OpenWeatherMapProxy.openweathermap_prefix_url = stub.url
+            provider = Provider('test')
+            city = City(3117735, 'Madrid', 'es', (-3.7, 40.4))
+
+            weather = provider.get_current_weather(city = city)
+            self.assertIsInstance(weather, Weather)
+
+            start, end = datetime(year = 2016, month = 1, day = 1), datetime(year = 2016, month = 1, day = 11)
+            cnt = floor((int(end.strftime('%s')) - int(start.strftime('%s'))) / (24 * 60 * 60))
+            weathers = provider.get_weather_history(start = start, end = end, city = city, interval = 1)
+            self.assertEqual(len(weathers), cnt)
+            for weather in weathers:
+                self.assertIsInstance(weather, Weather)
+
+
+
+class BenchmarkTest(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(BenchmarkResult._percentile(values, 50), 50)
+        self.assertEqual(BenchmarkResult._percentile(values, 99), 99)
+        self.assertEqual(BenchmarkResult._percentile(values, 100), 100)
+        self.assertEqual(BenchmarkResult._percentile(list(range(1, 203)), 50), 101)
+        self.assertEqual(BenchmarkResult._percentile([7], 99), 7)
+        self.assertIsNone(BenchmarkResult._percentile([], 50))
+
+    def test_failures_are_not_ops(self):
+        result = BenchmarkResult('test')
+        result.add_pass([(0.1, None), (0.1, None), (0.001, 'Server response with 500'),
+                         (0.001, 'Server response with 429')], 1, 4)
+        data = result.to_dict()
+        self.assertEqual(data['ops'], 4)
+        self.assertEqual(data['throughput_ops_s'], 2)
+        self.assertEqual(data['error_rate'], 0.5)
+        self.assertEqual(data['server_error_rate'], 0.25)
+        self.assertEqual(data['p50_ms'], 100)
+
+    def test_repeats(self):
+        result = BenchmarkResult('test')
+        for elapsed in (1, 2, 4):
+            result.add_pass([(0.1, None)] * 4, elapsed, 4)
+        data = result.to_dict()
+        self.assertEqual(data['repeats'], 3)
+        self.assertEqual(data['throughput_ops_s'], 2)
+        self.assertEqual(data['spread']['throughput_ops_s'], 1.5)
+
+    def test_compare(self):
+        before = {'throughput_ops_s' : 100, 'p50_ms' : 10, 'p99_ms' : 20, 'peak_memory_kb' : 100,
+                  'server_error_rate' : 0.0, 'spread' : {'throughput_ops_s' : 0.1, 'p99_ms' : 0.1}}
+        same = dict(before)
+        slower = dict(before, throughput_ops_s = 50)
+        errors = dict(before, throughput_ops_s = 150, server_error_rate = 0.3)
+        self.assertEqual(compare({'a' : before}, {'a' : same}, 0.2), [])
+        self.assertEqual(compare({'a' : before}, {'a' : slower}, 0.2), ['a'])
+        self.assertEqual(compare({'a' : before}, {'a' : errors}, 0.2), ['a'])
+
+        # Un cambio menor que el ruido entre repeticiones no es una regresión
+        noisy = dict(slower, spread = {'throughput_ops_s' : 0.8})
+        self.assertEqual(compare({'a' : before}, {'a' : noisy}, 0.2), [])
+
+        # Un aumento pequeño de la tasa de errores no es una regresión
+        few_errors = dict(before, server_error_rate = 0.01)
+        self.assertEqual(compare({'a' : before}, {'a' : few_errors}, 0.2), [])
+
+
+
+if __name__ == '__main__':
+    unittest.main()